@@ -18,12 +18,19 @@
 """Clean up SRT subtitle files removing ads, misplaced credits and fixing encoding"""
 
 import argparse
+import collections
+import hashlib
 import inspect
+import io
+import json
 import logging
 import os
 import pkgutil
 import shutil
 import sys
+import threading
+import zipfile
+import zlib
 
 # There's 3 `magic` modules in PyPI, all wrappers to libmagic, but with different API:
 # - file-magic,   https://github.com/file/file, from libmagic itself
@@ -43,6 +50,16 @@ from . import apppaths
 
 
 NAUTILUS_SCRIPT = a.__project__
+# Errors reading a ZIP member: bad CRC or data, encrypted, unsupported compression
+ZIP_MEMBER_ERRORS = (IOError, EOFError, RuntimeError, NotImplementedError,
+                     zipfile.BadZipfile, zlib.error)
+SUBTITLE_EXTENSIONS = ('srt',)
+ARCHIVE_EXTENSIONS = ('zip',)
+CHUNK_SIZE = 64 * 1024
+DEDUP_CACHE_SIZE = 64  # MiB
+HOT_RECORDS = 10
+PIPELINE_DEPTH = 16
+PIPELINE_WRITERS = 4
 
 log = logging.getLogger(__name__)
 
@@ -51,31 +68,109 @@ if sys.version_info[0] >= 3:
     PY3 = True
     unicode = str
     basestring = (str, bytes)
+    import queue
 
     def fsig(f):
         return inspect.getfullargspec(f)[0]
 
-    # noinspection PyUnusedLocal
-    def printsubs(subs, encoding=None):
-        for sub in subs:
-            print(sub)
+    def writestdout(data):
+        sys.stdout.flush()
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
 else:
     PY3 = False
     from io import open
+    import Queue as queue
 
     def fsig(f):
         # noinspection PyDeprecation
         return inspect.getargspec(f)[0]
 
-    def printsubs(subs, encoding=None):
-        for sub in subs:
-            print(unicode(sub).encode(encoding or subs.encoding))
+    def writestdout(data):
+        sys.stdout.write(data)
+        sys.stdout.flush()
 
 
 class ParseError(Exception):
     pass
 
 
+class Blacklist(object):
+    """Blacklist records, matched against subtitles text, and their hit counters
+
+    Records are checked in descending order of the persisted <stats> hits, if
+    any, so the most common ones are matched first. This order is set once, so
+    results do not depend on which subtitles were processed before.
+
+    If <exhaustive>, records are checked in blacklist file order and all records
+    matching an item are found, so the results are the same for a given
+    blacklist and no record is hidden behind another one matching the same items.
+
+    New hits are counted in <hits>, and merged to <stats> by update_stats().
+    """
+    def __init__(self, records, stats=None, exhaustive=False):
+        self.records = records
+        self.stats = stats or {}
+        self.exhaustive = exhaustive
+        self.hits = collections.Counter()
+        self._patterns = [(_, _.replace('\\n', '\n').lower()) for _ in records]
+        if not exhaustive:
+            # Stable sort, so ties keep the blacklist file order
+            self._patterns.sort(key=lambda _: -self.stats.get(_[0], 0))
+
+    @classmethod
+    def load(cls, path, stats=None, exhaustive=False):
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                records = fp.read().strip().split('\n\n')
+        except IOError as e:
+            log.warning("Could not read blacklist, no items will be deleted: %s", e)
+            records = []
+        return cls([_ for _ in records if _], stats=stats, exhaustive=exhaustive)
+
+    def count(self, record):
+        return self.stats.get(record, 0) + self.hits[record]
+
+    def match(self, text):
+        """Return a tuple of records found in <text>, empty if none
+
+        Only the first record found, unless <exhaustive>.
+        """
+        text = text.lower()
+        found = []
+        for record, pattern in self._patterns:
+            if pattern in text:
+                found.append(record)
+                if not self.exhaustive:
+                    break
+        return tuple(found)
+
+    def add_hits(self, deleted):
+        """Count hits for all records in <deleted>, as returned by clean()"""
+        self.hits.update(record for _, records in deleted for record in records)
+
+    def update_stats(self):
+        """Merge <hits> into <stats>, dropping records no longer in the blacklist"""
+        records = set(self.records)
+        stats = dict((k, v) for k, v in self.stats.items() if k in records)
+        for record, hits in self.hits.items():
+            stats[record] = stats.get(record, 0) + hits
+        self.stats = stats
+        self.hits.clear()
+        return self.stats
+
+
+Result = collections.namedtuple('Result', 'encoding items deleted data')
+
+
+def positive_int(value):
+    """argparse type for integers greater than zero"""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1: %r" % value)
+    return number
+
+
 def parseargs(argv=None):
     parser = argparse.ArgumentParser(
         prog=a.__title__, epilog=a.epilog,
@@ -109,6 +204,23 @@ def parseargs(argv=None):
                         help="Convert subtitle encoding."
                              " By default output uses the same encoding as the input.")
 
+    parser.add_argument('--archives', '-z',
+                        action="store_true", default=False,
+                        help="Also process SRT files inside ZIP archives."
+                             " Archives are read and cleaned in memory,"
+                             " and with --in-place the archive itself is rewritten.")
+
+    parser.add_argument('--dedup', '-d',
+                        action="store_true", default=False,
+                        help="Process byte-identical subtitles only once,"
+                             " re-using previous results from a cache.")
+
+    parser.add_argument('--dedup-size', dest="dedup_size",
+                        default=DEDUP_CACHE_SIZE, type=positive_int,
+                        metavar='MB',
+                        help="Maximum size of the --dedup cache, in MiB."
+                             " [Default: %(default)s]")
+
     parser.add_argument('--in-place', '-i',
                         action="store_true", default=False,
                         help="Overwrite original file"
@@ -118,6 +230,13 @@ def parseargs(argv=None):
                         action="store_false", default=True,
                         help="When using --in-place, do not create a backup file.")
 
+    parser.add_argument('--output-dir', '-o', dest="output_dir",
+                        metavar='DIR',
+                        help="Save modified subtitles to %(metavar)s"
+                             " instead of standard output or --in-place,"
+                             " mirroring the input directories. Archive members"
+                             " are saved in a subdir named after the archive.")
+
     parser.add_argument('--no-rebuild-index', '-I', dest="rebuild_index",
                         action="store_false", default=True,
                         help="Do not rebuild subtitles indexes after removing items."
@@ -130,6 +249,51 @@ def parseargs(argv=None):
                         default=get_blacklist_path(),
                         help="Blacklist file path. [Default: %(default)s]")
 
+    parser.add_argument('--dry-run', '-n',
+                        action="store_true", default=False,
+                        help="Do not save or output any subtitle, only report"
+                             " what would be deleted. Implies --no-rebuild-index.")
+
+    parser.add_argument('--report', '-R',
+                        metavar='FILE',
+                        help="Write a JSON Lines report to %(metavar)s, one record per"
+                             " subtitle with its encoding, number of items and"
+                             " deleted items along with all blacklist records that"
+                             " match each one, in blacklist order.")
+
+    parser.add_argument('--pipeline', '-p',
+                        action="store_true", default=False,
+                        help="Overlap I/O and processing, useful on network storage:"
+                             " read files ahead in a background thread,"
+                             " and save results using a pool of writer threads.")
+
+    parser.add_argument('--pipeline-depth', dest="pipeline_depth",
+                        default=PIPELINE_DEPTH, type=positive_int,
+                        metavar='N',
+                        help="Number of files to read ahead, and of results"
+                             " queued for writing, when using --pipeline."
+                             " [Default: %(default)s]")
+
+    parser.add_argument('--writers', '-w',
+                        default=PIPELINE_WRITERS, type=positive_int,
+                        metavar='N',
+                        help="Number of writer threads when using --pipeline."
+                             " [Default: %(default)s]")
+
+    parser.add_argument('--stats', '-s',
+                        action="store_true", default=False,
+                        help="Update blacklist records hit statistics, persisted"
+                             " at %r, matching all records against each item."
+                             " Records with most hits are matched first"
+                             " in regular runs." % get_stats_path())
+
+    parser.add_argument('--stats-report', '-S', dest='stats_report',
+                        nargs='?', const=HOT_RECORDS, type=positive_int,
+                        metavar='N',
+                        help="List the %(metavar)s blacklist records with most hits"
+                             " and all records that never matched, then exit."
+                             " [Default: %(const)s]")
+
     parser.add_argument('--install-nautilus-script', '-N', dest='nautilus',
                         nargs='?', const=NAUTILUS_SCRIPT,
                         metavar='PATH',
@@ -168,6 +332,44 @@ def get_blacklist_path(create=False):
                         "{}.conf".format(a.__title__))
 
 
+def get_stats_path(create=False):
+    return os.path.join(apppaths.save_cache_path(a.__title__, create=create),
+                        "stats.json")
+
+
+def load_stats():
+    """Return the persisted blacklist records hit counters"""
+    try:
+        with open(get_stats_path(), 'r', encoding='utf-8') as fp:
+            return json.load(fp)
+    except (IOError, ValueError) as e:
+        log.debug("Could not load stats, starting anew: %s", e)
+        return {}
+
+
+def save_stats(stats):
+    path = get_stats_path(create=True)
+    log.debug("Saving stats to %r", path)
+    with open(path, 'w', encoding='utf-8') as fp:
+        fp.write(unicode(json.dumps(stats, indent=0, sort_keys=True)))
+
+
+def stats_report(blacklistpath, top=HOT_RECORDS):
+    """Print the <top> most matched blacklist records and the ones never matched"""
+    blacklist = Blacklist.load(blacklistpath, stats=load_stats())
+    counts = [(blacklist.count(_), _) for _ in blacklist.records]
+
+    print("Hot records:")
+    for count, record in sorted(counts, key=lambda _: -_[0])[:top]:
+        if count:
+            print(u"{:9d}\t{}".format(count, record.replace('\n', '\t')))
+
+    print("Dead records:")
+    for count, record in counts:
+        if not count:
+            print(u"\t{}".format(record.replace('\n', '\t')))
+
+
 def check_config(path):
     """Create the blacklist template if needed"""
     if path != get_blacklist_path() or os.path.isfile(path):
@@ -191,9 +393,23 @@ def check_config(path):
     return path, readme_path
 
 
-def find_subtitles(paths, recursive=False):
-    def ext(p):
-        return os.path.splitext(p)[1][1:].lower()
+def ext(path):
+    return os.path.splitext(path)[1][1:].lower()
+
+
+def is_archive(path):
+    return ext(path) in ARCHIVE_EXTENSIONS
+
+
+def find_subtitles(paths, recursive=False, archives=False):
+    """Yield SRT files from <paths>, and also ZIP archives if <archives>
+
+    Yield (path, name) tuples, <name> being the path relative to the directory
+    it was found in, or its basename for files given directly in <paths>.
+    """
+    extensions = SUBTITLE_EXTENSIONS
+    if archives:
+        extensions += ARCHIVE_EXTENSIONS
 
     if isinstance(paths, basestring):
         paths = [paths]
@@ -204,35 +420,53 @@ def find_subtitles(paths, recursive=False):
                 if not recursive:
                     del dirs[:]
                 for basename in files:
-                    if ext(basename) == 'srt':
-                        yield os.path.join(root, basename)
+                    if ext(basename) in extensions:
+                        filepath = os.path.join(root, basename)
+                        yield filepath, os.path.relpath(filepath, path)
         else:
-            if ext(path) == 'srt':
-                yield path
+            if ext(path) in extensions:
+                yield path, os.path.basename(path)
             else:
                 log.warning("Not an SRT file: '%s'", path)
 
 
-def detect_encoding(filename, fallback=None):
+def unique_subtitles(items):
+    """Filter out (path, name) <items> whose real path was already yielded
+
+    So a file is never processed twice, as when given twice or found via
+    overlapping dirs, which with --pipeline could clobber its backup.
+    """
+    seen = set()
+    for path, name in items:
+        realpath = os.path.realpath(path)
+        if realpath in seen:
+            log.debug("Skipping already processed '%s'", path)
+            continue
+        seen.add(realpath)
+        yield path, name
+
+
+def detect_encoding(filename=None, fallback=None, data=None):
+    """Auto-detect the encoding of <filename>, or of <data> bytes if not None"""
     # file-magic, from `libmagic` upstream
     if hasattr(magic.Magic, "file"):
         ms = magic.open(magic.MAGIC_MIME_ENCODING)  # @UndefinedVariable
         ms.load()
-        encoding = ms.file(filename)
+        encoding = ms.file(filename) if data is None else ms.buffer(data)
         ms.close()
 
     # python-magic
     elif hasattr(magic.Magic, "from_file"):
         # noinspection PyArgumentList
         ms = magic.Magic(mime_encoding=True)
-        encoding = ms.from_file(filename)
+        encoding = ms.from_file(filename) if data is None else ms.from_buffer(data)
         del ms  # force automatic close()
 
     # filemagic
     else:
         # noinspection PyArgumentList
         with magic.Magic(flags=magic.MAGIC_MIME_ENCODING) as m:
-            encoding = m.id_filename(filename)
+            encoding = m.id_filename(filename) if data is None else m.id_buffer(data)
 
     if encoding and encoding not in ['unknown-8bit', 'binary']:
         log.debug("Auto-detected encoding: '%s'", encoding)
@@ -242,54 +476,428 @@ def detect_encoding(filename, fallback=None):
     return fallback
 
 
-def open_subtitle(filename, encoding=None, fallback=None):
-    """Wrapper to pysrt.open() with encoding auto-detection
+def load_subtitle(data, encoding=None, fallback=None):
+    """Parse SRT from in-memory <data> bytes, with encoding auto-detection
 
-    Could eventually be replaced with another parser to avoid this encoding madness
+    Like pysrt.open() with a detected or given <encoding>, falling back to
+    <fallback> if auto-detection fails. Raise ParseError on decoding errors.
     """
     if encoding is None:
-        encoding = detect_encoding(filename, fallback=fallback)
+        encoding = detect_encoding(data=data, fallback=fallback)
     else:
         log.debug("Encoding: '%s'", encoding)
 
     try:
-        return pysrt.open(filename, encoding=encoding)
-    except UnicodeDecodeError as e:
+        text = data.decode(encoding)
+    except (UnicodeDecodeError, LookupError) as e:
         raise ParseError("error using encoding '%s': %r" % (encoding, e))
 
+    # pysrt.open() strips the BOM, if any, so do the same
+    if text.startswith(u'\ufeff'):
+        text = text[1:]
+
+    return pysrt.from_string(text, encoding=encoding)
+
+
+def dump_subtitle(subs, encoding=None):
+    """Serialize <subs> to bytes, the in-memory counterpart of subs.save()"""
+    buf = io.StringIO()
+    subs.write_into(buf)
+    return buf.getvalue().encode(encoding or subs.encoding)
 
-def clean(subs, blacklistfile, rebuild_index=True):
+
+def read_subtitle(f, cache=None):
+    """Read all bytes from file object <f>, hashing them on the fly for <cache>
+
+    Return a (data, key) tuple, <key> being the content hash or None if no <cache>
+    """
+    hasher = None if cache is None else cache.hasher()
+    chunks = []
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        if hasher is not None:
+            hasher.update(chunk)
+        chunks.append(chunk)
+    return b''.join(chunks), (None if hasher is None else hasher.digest())
+
+
+def read_subtitles(paths, cache=None):
+    """Yield (path, name, data, key, error) for each (path, name)
+
+    See read_subtitle() for <data> and <key>. If the file could not be read,
+    they are None and <error> is the exception, otherwise <error> is None.
+    Archives are not read, as clean_archive() handles them, so their <data>
+    and <key> are None too.
+    """
+    for path, name in paths:
+        if is_archive(path):
+            yield path, name, None, None, None
+            continue
+        try:
+            with open(path, 'rb') as f:
+                data, key = read_subtitle(f, cache)
+        except (IOError, OSError) as e:
+            yield path, name, None, None, e
+            continue
+        yield path, name, data, key, None
+
+
+def prefetch(iterable, depth):
+    """Iterate <iterable> in a background thread, up to <depth> items ahead
+
+    Exceptions raised by <iterable> are re-raised in the consumer thread.
+    """
+    items = queue.Queue(depth)
+
+    def run():
+        try:
+            for item in iterable:
+                items.put((True, item))
+        except Exception as e:
+            items.put((False, e))
+        else:
+            items.put((False, None))
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        ok, item = items.get()
+        if not ok:
+            if item is not None:
+                raise item
+            return
+        yield item
+
+
+class Report(object):
+    """JSON Lines report at <path>, written as each subtitle is processed"""
+    def __init__(self, path):
+        self.file = open(path, 'w', encoding='utf-8')
+
+    def write(self, path, result=None, error=None):
+        """Write the <result> of processing <path>, or the <error> if it failed"""
+        entry = {'path': path}
+        if error is not None:
+            entry['error'] = unicode(error)
+        else:
+            entry.update(
+                encoding=result.encoding,
+                items=result.items,
+                deleted=[dict(index=item.index,
+                              start=unicode(item.start),
+                              end=unicode(item.end),
+                              text=item.text,
+                              records=list(records))
+                         for item, records in reversed(result.deleted)],
+            )
+        # Sorted keys, so reports can be compared between blacklist versions
+        self.file.write(unicode(json.dumps(entry, sort_keys=True)) + u'\n')
+
+    def close(self):
+        self.file.close()
+
+
+class WriterPool(object):
+    """Threads running try_save() calls from a queue of up to <depth> items
+
+    Failed saves are counted in <failed>, available after close().
+    """
+    def __init__(self, size, depth):
+        if size < 1 or depth < 1:
+            raise ValueError("size and depth must be at least 1: %r, %r" % (size, depth))
+        self.queue = queue.Queue(depth)
+        self.failed = 0
+        self._lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run) for _ in range(size)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            args, kwargs = job
+            if not try_save(*args, **kwargs):
+                with self._lock:
+                    self.failed += 1
+
+    def save(self, *args, **kwargs):
+        """Queue a try_save() call, blocking if the queue is full
+
+        Always return True, as failures are only known when the save is done.
+        """
+        self.queue.put((args, kwargs))
+        return True
+
+    def close(self):
+        """Wait for all queued saves to finish and stop the threads"""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def member_path(name):
+    """Return archive member <name> as a relative path that can not escape its root"""
+    parts = [_ for _ in name.replace('\\', '/').split('/') if _ not in ('', '.', '..')]
+    return os.path.join('', *parts)
+
+
+class OutputDir(object):
+    """Output directory mirroring the input tree, never saving to a path twice"""
+    def __init__(self, path):
+        self.path = path
+        self.used = set()
+
+    def get(self, name):
+        """Return the output path for relative <name>, or None if already used"""
+        path = os.path.normpath(os.path.join(self.path, name))
+        if path in self.used:
+            log.error("Not saving to '%s', already saved from another subtitle", path)
+            return None
+        self.used.add(path)
+        return path
+
+
+def save_subtitle(data, path, in_place=False, backup=True, output=None):
+    """Save <data> bytes to <output> path, to <path> if <in_place>, or to stdout"""
+    if output:
+        path = output
+        apppaths.makedirs(os.path.dirname(path), exist_ok=True)
+    elif in_place:
+        if backup:
+            shutil.copy(path, "{}.{}.bak".format(path, a.__title__))
+    else:
+        writestdout(data)
+        return
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def try_save(data, path, **kwargs):
+    """Call save_subtitle(), logging any error instead of raising. Return success"""
     try:
-        with open(blacklistfile, 'r', encoding='utf-8') as fp:
-            blacklist = fp.read().strip().split('\n\n')
-    except IOError:
+        save_subtitle(data, path, **kwargs)
+    except Exception as e:
+        log.error("Could not save '%s': %s", kwargs.get('output') or path, e)
         return False
+    return True
 
-    deleted = []
-    for i, sub in reversed(list(enumerate(subs))):
-        for text in blacklist:
-            if text.replace('\\n', '\n').lower() in sub.text.lower():
-                deleted.append(sub)
-                del subs[i]
-                break
 
-    if not deleted:
-        return False
+class SubtitleCache(object):
+    """LRU cache of processing results, keyed by subtitle content hash
 
-    for item in reversed(deleted):
+    Memory usage is bounded by <maxsize> bytes, estimated from each result's
+    output data and deleted items, plus a fixed overhead per entry and per
+    deleted item for the Python objects holding them. Least recently used
+    results are evicted first.
+    """
+    hasher = hashlib.sha1
+    # Measured on CPython 3 as ~350 bytes per entry (key, Result, dict slot)
+    # and ~460 bytes per deleted SubRipItem with its times, rounded up.
+    entry_overhead = 512
+    item_overhead = 512
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.size = 0
+        self.hits = 0
+        self._items = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            result, size = self._items.pop(key)
+        except KeyError:
+            return None
+        self._items[key] = (result, size)  # Re-insert as most recent, Py2-compatible
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        size = (self.entry_overhead + len(key) + len(result.data or b'') +
+                sum(self.item_overhead + len(item.text) for item, _ in result.deleted))
+        if size > self.maxsize:
+            return
+        while self._items and self.size + size > self.maxsize:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.size -= evicted
+        self._items[key] = (result, size)
+        self.size += size
+
+
+def process_subtitle(data, blacklist,
+                     encoding=None, fallback_encoding=None, output_encoding=None,
+                     rebuild_index=True, dry_run=False, cache=None, key=None):
+    """Parse, clean and serialize in-memory SRT <data> bytes
+
+    Return a Result, its <data> being the output bytes or None if there is
+    nothing to save, as always when <dry_run>. If <cache> is not None, results
+    are looked up and stored by content hash <key>, so duplicate subtitles are
+    not processed again. Raise ParseError if <data> can not be decoded.
+    """
+    if cache is not None:
+        result = cache.get(key)
+        if result is not None:
+            log.debug("Same content as a previous subtitle, re-using results")
+            if result.deleted:
+                log_deleted(result.deleted)
+                blacklist.add_hits(result.deleted)
+            return result
+
+    subs = load_subtitle(data, encoding=encoding, fallback=fallback_encoding)
+    items = len(subs)
+    deleted = clean(subs, blacklist, rebuild_index=rebuild_index and not dry_run)
+    output = None
+    if (deleted or output_encoding) and not dry_run:
+        output = dump_subtitle(subs, encoding=output_encoding)
+    result = Result(subs.encoding, items, deleted, output)
+
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+
+def clean_archive(path, blacklist, name=None,
+                  in_place=False, backup=True, output=None,
+                  cache=None, report=None, **options):
+    """Clean all SRT members of a ZIP archive, without extracting it to disk
+
+    Each member is read, cleaned and serialized in memory. Results are saved to
+    <output>, an OutputDir, in a subdir named after the archive <name> without
+    its extension, keeping the members' own paths. Or, if <in_place>, the archive
+    is rewritten with the cleaned members, preserving all others. Otherwise
+    output to stdout.
+    <report>, if not None, is a Report to write each member's results to.
+    <options> are passed to process_subtitle()
+
+    Save errors are logged, not raised, as in try_save(). Return the number of
+    failed saves, counting a failed archive rewrite as one.
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except (IOError, zipfile.BadZipfile) as e:
+        log.error("Could not open archive '%s': %s", path, e)
+        if report is not None:
+            report.write(path, error=e)
+        return 0
+
+    failed = 0
+    members = []
+    modified = False
+    broken = False  # Can not be rewritten, as some member could not be read
+    with archive:
+        comment = archive.comment
+        for info in archive.infolist():
+            member = os.path.join(path, info.filename)
+            subtitle = ext(info.filename) in SUBTITLE_EXTENSIONS
+            if not (subtitle or in_place):
+                continue
+
+            if subtitle:
+                log.info("Processing subtitle: '%s'", member)
+            try:
+                with archive.open(info) as f:
+                    data, key = read_subtitle(f, cache if subtitle else None)
+            except ZIP_MEMBER_ERRORS as e:
+                log.error("Could not read '%s': %s", member, e)
+                if subtitle and report is not None:
+                    report.write(member, error=e)
+                broken = True
+                continue
+            members.append((info, data))
+            if not subtitle:
+                continue
+            try:
+                result = process_subtitle(data, blacklist,
+                                          cache=cache, key=key, **options)
+            except ParseError as e:
+                log.error("Could not open '%s': %s", member, e)
+                if report is not None:
+                    report.write(member, error=e)
+                continue
+
+            if report is not None:
+                report.write(member, result)
+
+            if result.data is None:
+                continue
+
+            if output is not None:
+                outpath = output.get(os.path.join(
+                    os.path.splitext(name or os.path.basename(path))[0],
+                    member_path(info.filename)))
+                if outpath and not try_save(result.data, info.filename,
+                                            output=outpath):
+                    failed += 1
+            elif in_place:
+                members[-1] = (info, result.data)
+                modified = True
+            elif not try_save(result.data, info.filename):
+                failed += 1
+
+    if not modified:
+        return failed
+
+    if broken:
+        log.error("Not rewriting archive '%s', as some members could not be read",
+                  path)
+        return failed + 1
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as rewritten:
+        rewritten.comment = comment
+        for info, data in members:
+            rewritten.writestr(info, data)
+    if not try_save(buf.getvalue(), path, in_place=True, backup=backup):
+        failed += 1
+    return failed
+
+
+def log_deleted(deleted):
+    if not deleted:
+        return
+    for item, _ in reversed(deleted):
         log.info(unicode(item).replace('\n', '\t').strip())
     log.info("%d items deleted", len(deleted))
-    if rebuild_index:
-        subs.clean_indexes()
 
-    return True
+
+def clean(subs, blacklist, rebuild_index=True):
+    """Delete from <subs> all items matching the blacklist
+
+    <blacklist> is either a Blacklist or the path of a blacklist file.
+    Return a list of (item, records) tuples for each deleted item, <records>
+    being the matching blacklist records, see Blacklist.match().
+    """
+    if isinstance(blacklist, basestring):
+        blacklist = Blacklist.load(blacklist)
+
+    deleted = []
+    for i, sub in reversed(list(enumerate(subs))):
+        records = blacklist.match(sub.text)
+        if records:
+            deleted.append((sub, records))
+            del subs[i]
+
+    if deleted:
+        log_deleted(deleted)
+        blacklist.add_hits(deleted)
+        if rebuild_index:
+            subs.clean_indexes()
+
+    return deleted
 
 
 def srtcleaner(
     srtpaths, blacklistpath=None,
     recursive=False,
     encoding=None, fallback_encoding="windows-1252", output_encoding=None,
-    in_place=False, backup=True,
+    in_place=False, backup=True, output_dir=None,
+    archives=False, dedup=False, dedup_size=DEDUP_CACHE_SIZE, stats=False,
+    pipeline=False, pipeline_depth=PIPELINE_DEPTH, writers=PIPELINE_WRITERS,
+    dry_run=False, report=None,
     rebuild_index=False
 ):
     """Remove entries in SRT subtitle files and optionally convert encoding
@@ -313,33 +921,130 @@ def srtcleaner(
 
     By default output to stdout, <in_place> to modify the input file, creating
     a backup file by default. <backup> is ignored if not <in_place>.
+    <output_dir>, if not None, saves modified files to that directory instead,
+    at their paths relative to the <srtpaths> directory they were found in.
+
+    <archives> also processes SRT files inside ZIP archives found in <srtpaths>,
+    in memory and without extracting them. See clean_archive()
+
+    <dedup> keeps a cache of results by content hash, up to <dedup_size> MiB,
+    so byte-identical subtitles are only processed once. See SubtitleCache
+
+    The persisted blacklist records hit counters, if any, are used to match the
+    most common records first. <stats> updates and saves them, matching all
+    records against each item so no record is hidden by another. See Blacklist
+
+    <pipeline> overlaps I/O and processing: files are read up to <pipeline_depth>
+    items ahead in a background thread, and, unless outputting to stdout, saved
+    by a pool of <writers> threads with a queue of same depth. Subtitles are
+    still processed one at a time, in the calling thread. Either way, errors
+    saving a subtitle are logged and do not abort the run.
+
+    <dry_run> does not save or output any subtitle, nor persist <stats>, taking
+    the cheapest path to find what would be deleted: no index rebuilding and
+    no output serialization. Useful with <report>, a path to write a JSON Lines
+    report with one record per subtitle. See Report
 
     <rebuild_index>, by default True, re-number the SRT entries index after
     deleting entries. Turning it off can be useful when debugging to compare
     original and modified subtitles.
     """
+    if dedup and dedup_size < 1:
+        raise ValueError("dedup_size must be at least 1: %r" % dedup_size)
+    if pipeline and (pipeline_depth < 1 or writers < 1):
+        raise ValueError("pipeline_depth and writers must be at least 1: %r, %r"
+                         % (pipeline_depth, writers))
+
     if blacklistpath is None:
         blacklistpath = get_blacklist_path()
 
-    for path in find_subtitles(srtpaths, recursive=recursive):
-        log.info("Processing subtitle: '%s'", path)
-        try:
-            subs = open_subtitle(path,
-                                 encoding=encoding,
-                                 fallback=fallback_encoding)
-        except ParseError as e:
-            log.error("Could not open '%s': %s", path, e)
-            continue
-
-        modified = clean(subs, blacklistpath, rebuild_index=rebuild_index)
+    # Exhaustive matching when hits or matches are reported, so they are accurate
+    # and reproducible. Otherwise, the order from persisted stats is faster
+    blacklist = Blacklist.load(blacklistpath,
+                               stats=load_stats(),
+                               exhaustive=stats or report is not None)
+
+    cache = SubtitleCache(dedup_size * 1024 * 1024) if dedup else None
+    options = dict(encoding=encoding,
+                   fallback_encoding=fallback_encoding,
+                   output_encoding=output_encoding,
+                   rebuild_index=rebuild_index,
+                   dry_run=dry_run)
+    if dry_run:
+        in_place = False  # No need to buffer archive members for rewriting
+
+    output = OutputDir(output_dir) if output_dir and not dry_run else None
+
+    reader = read_subtitles(unique_subtitles(find_subtitles(srtpaths,
+                                                            recursive=recursive,
+                                                            archives=archives)),
+                            cache=cache)
+    writer = None
+    failed = 0
+
+    if report is not None:
+        report = Report(report)
 
-        if modified or output_encoding:
-            if in_place:
-                if backup:
-                    shutil.copy(path, "{}.{}.bak".format(path, a.__title__))
-                subs.save(encoding=output_encoding)
-            else:
-                printsubs(subs, encoding=output_encoding)
+    try:
+        if pipeline:
+            reader = prefetch(reader, pipeline_depth)
+            if in_place or output:  # stdout output must stay in order
+                writer = WriterPool(writers, pipeline_depth)
+        save = try_save if writer is None else writer.save
+
+        for path, name, data, key, error in reader:
+            if error is not None:
+                log.error("Could not read '%s': %s", path, error)
+                if report is not None:
+                    report.write(path, error=error)
+                continue
+
+            if is_archive(path):
+                failed += clean_archive(path, blacklist, name=name,
+                                        in_place=in_place, backup=backup,
+                                        output=output, cache=cache, report=report,
+                                        **options)
+                continue
+
+            log.info("Processing subtitle: '%s'", path)
+            try:
+                result = process_subtitle(data, blacklist,
+                                          cache=cache, key=key, **options)
+            except ParseError as e:
+                log.error("Could not open '%s': %s", path, e)
+                if report is not None:
+                    report.write(path, error=e)
+                continue
+
+            if report is not None:
+                report.write(path, result)
+
+            if result.data is None:
+                continue
+
+            outpath = None
+            if output is not None:
+                outpath = output.get(name)
+                if not outpath:
+                    continue
+            if not save(result.data, path,
+                        in_place=in_place, backup=backup, output=outpath):
+                failed += 1
+    finally:
+        if writer is not None:
+            writer.close()
+            failed += writer.failed
+        if report is not None:
+            report.close()
+
+    if failed:
+        log.error("%d subtitles could not be saved", failed)
+
+    if cache is not None and cache.hits:
+        log.info("%d duplicate subtitles re-used previous results", cache.hits)
+
+    if stats and not dry_run:
+        save_stats(blacklist.update_stats())
 
 
 def cli(argv=None):
@@ -353,6 +1058,10 @@ def cli(argv=None):
         log.info("Nautilus script installed to %r", path)
         return
 
+    if args.stats_report is not None:
+        stats_report(args.blacklistpath, top=args.stats_report)
+        return
+
     if not args.srtpaths:
         log.error("No paths specified, see --help for usage.")
         return 1
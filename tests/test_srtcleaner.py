@@ -0,0 +1,159 @@
+# This file is part of SRT Cleaner, see <https://github.com/MestreLion/srtcleaner>
+# Copyright (C) 2021 Rodrigo Silva (MestreLion) <linux@rodrigosilva.com>
+# License: GPLv3 or later, at your choice. See <http://www.gnu.org/licenses/gpl>
+
+"""Tests for srtcleaner()"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import srtcleaner
+
+SUBTITLE = (b"1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n\r\n"
+            b"2\r\n00:00:03,000 --> 00:00:04,000\r\nVisit OpenSubtitles.org\r\n\r\n"
+            b"3\r\n00:00:05,000 --> 00:00:06,000\r\nBye\r\n\r\n")
+CLEANED = (b"1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n\r\n"
+           b"2\r\n00:00:05,000 --> 00:00:06,000\r\nBye\r\n\r\n")
+BACKUP = "{}.srtcleaner.bak"
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.blacklist = self.write("blacklist.conf", b"OpenSubtitles.org\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def write(self, name, data):
+        path = self.path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def clean(self, srtpaths, **kwargs):
+        kwargs.setdefault('rebuild_index', True)
+        srtcleaner.srtcleaner(srtpaths, blacklistpath=self.blacklist, **kwargs)
+
+
+class TestSubtitleCache(unittest.TestCase):
+    def test_bounded_by_entry_overhead(self):
+        module = sys.modules['srtcleaner.srtcleaner']
+        cache = module.SubtitleCache(64 * 1024)
+        for i in range(10000):
+            key = cache.hasher(str(i).encode()).digest()
+            cache.put(key, module.Result('utf-8', 0, [], None))
+        self.assertLessEqual(cache.size, cache.maxsize)
+        self.assertLessEqual(len(cache._items), cache.maxsize // cache.entry_overhead)
+
+
+class TestPipeline(TestCase):
+    def test_duplicate_path_keeps_backup(self):
+        for _ in range(5):
+            path = self.write("dup.srt", SUBTITLE)
+            self.clean([path, path], in_place=True, pipeline=True)
+            self.assertEqual(self.read(path), CLEANED)
+            self.assertEqual(self.read(BACKUP.format(path)), SUBTITLE)
+
+    def test_overlapping_dirs_keep_backup(self):
+        for _ in range(5):
+            path = self.write(os.path.join("sub", "dup.srt"), SUBTITLE)
+            self.clean([self.tmpdir, os.path.dirname(path)],
+                       recursive=True, in_place=True, pipeline=True,
+                       pipeline_depth=1, writers=2)
+            self.assertEqual(self.read(path), CLEANED)
+            self.assertEqual(self.read(BACKUP.format(path)), SUBTITLE)
+
+    def test_invalid_settings(self):
+        path = self.write("a.srt", SUBTITLE)
+        self.assertRaises(ValueError, self.clean, path, pipeline=True, writers=0)
+        self.assertRaises(ValueError, self.clean, path, pipeline=True,
+                          pipeline_depth=0)
+
+
+class TestArchive(TestCase):
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        self.archive = self.path("bundle.zip")
+        with zipfile.ZipFile(self.archive, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.comment = b"release"
+            archive.writestr("s1/English.srt", SUBTITLE)
+            archive.writestr("s2/English.srt", SUBTITLE)
+            archive.writestr("notes.txt", b"notes")
+        self.original = self.read(self.archive)
+
+    def test_rewrite_in_place(self):
+        self.clean(self.archive, archives=True, in_place=True)
+        self.assertEqual(self.read(BACKUP.format(self.archive)), self.original)
+        with zipfile.ZipFile(self.archive) as archive:
+            self.assertEqual(archive.comment, b"release")
+            self.assertEqual(archive.namelist(),
+                             ["s1/English.srt", "s2/English.srt", "notes.txt"])
+            self.assertEqual(archive.read("s1/English.srt"), CLEANED)
+            self.assertEqual(archive.read("s2/English.srt"), CLEANED)
+            self.assertEqual(archive.read("notes.txt"), b"notes")
+
+    def test_output_dir(self):
+        outdir = self.path("out")
+        self.clean(self.archive, archives=True, output_dir=outdir)
+        self.assertEqual(self.read(self.archive), self.original)
+        for member in ("s1", "s2"):
+            self.assertEqual(
+                self.read(os.path.join(outdir, "bundle", member, "English.srt")),
+                CLEANED)
+
+    def test_failed_rewrite_does_not_abort(self):
+        path = self.write("after.srt", SUBTITLE)
+        copy = shutil.copy
+
+        def failing_copy(src, dst):
+            if src == self.archive:
+                raise IOError("backup failed")
+            return copy(src, dst)
+
+        shutil.copy = failing_copy
+        try:
+            self.clean([self.archive, path], archives=True, in_place=True)
+        finally:
+            shutil.copy = copy
+        self.assertEqual(self.read(self.archive), self.original)
+        self.assertEqual(self.read(path), CLEANED)
+
+
+class TestReport(TestCase):
+    def test_unreadable_file_does_not_abort(self):
+        missing = self.path("missing.srt")
+        path = self.write("a.srt", SUBTITLE)
+        report = self.path("report.jsonl")
+        for pipeline in (False, True):
+            self.clean([missing, path], dry_run=True, report=report, pipeline=pipeline)
+            with open(report) as f:
+                entries = [json.loads(_) for _ in f]
+            self.assertEqual([_['path'] for _ in entries], [missing, path])
+            self.assertIn('error', entries[0])
+            self.assertEqual(entries[1]['deleted'][0]['records'], ["OpenSubtitles.org"])
+            self.assertEqual(self.read(path), SUBTITLE)
+
+    def test_invalid_settings_keep_report(self):
+        report = self.write("report.jsonl", b"previous\n")
+        self.assertRaises(ValueError, self.clean, self.tmpdir, report=report,
+                          pipeline=True, writers=0)
+        self.assertEqual(self.read(report), b"previous\n")
+
+
+if __name__ == '__main__':
+    unittest.main()